@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Benchmark MsidPool throughput against the number of worker processes:
+
+$ ./bench_msid_pool.py --n-samples 1000000
+
+This calibrates (or state-decodes) random raw counts for every MSID in the current
+TDB version that has a point-pair, polynomial or state code calibration, first in
+the current process and then with MsidPool for 1, 2, 4, ... up to the number of
+CPUs.  Pool start-up (writing and mapping the shared tables) is timed separately.
+"""
+
+from __future__ import print_function
+
+import os
+import time
+import argparse
+
+import numpy as np
+
+import ska_tdb
+from ska_tdb import MsidPool, tables
+
+
+def convert(msid, n_samples):
+    """Calibrate or state-decode ``n_samples`` random raw counts for ``msid``."""
+    row = ska_tdb.tdb.tables['tmsrment'][msid]
+    raw = np.random.randint(row['LOW_RAW_COUNT'], row['HIGH_RAW_COUNT'] + 1, n_samples)
+    if row['CALIBRATION_TYPE'] == 'SC':
+        return len(ska_tdb.decode_states(msid, raw))
+    return len(ska_tdb.calibrate(msid, raw))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Benchmark MsidPool')
+    parser.add_argument('--n-samples', type=int, default=100000,
+                        help='Raw samples per MSID (default=100000)')
+    parser.add_argument('--n-msids', type=int, default=None,
+                        help='Number of MSIDs (default=all)')
+    parser.add_argument('--max-processes', type=int, default=os.cpu_count(),
+                        help='Maximum number of worker processes (default=CPU count)')
+    return parser
+
+
+def main():
+    opt = get_parser().parse_args()
+    tmsrment = tables['tmsrment']
+    n_raws = tmsrment['HIGH_RAW_COUNT'] - tmsrment['LOW_RAW_COUNT'] + 1
+    ok = (np.isin(tmsrment['CALIBRATION_TYPE'], ['PP', 'PC', 'SC'])
+          & (n_raws > 0) & (n_raws <= 65536))
+    msids = tmsrment['MSID'][ok][:opt.n_msids]
+    n_total = len(msids) * opt.n_samples
+    print('TDB version {}: {} MSIDs x {} samples'.format(
+        ska_tdb.get_tdb_version(), len(msids), opt.n_samples))
+
+    t0 = time.time()
+    for msid in msids:
+        convert(msid, opt.n_samples)
+    dt = time.time() - t0
+    print('{:>10s} {:8.2f} s {:10.3g} samples/s'.format('serial', dt, n_total / dt))
+
+    processes = 1
+    while processes <= opt.max_processes:
+        t0 = time.time()
+        with MsidPool(processes) as pool:
+            t1 = time.time()
+            pool.map(convert, msids, [opt.n_samples] * len(msids))
+            dt = time.time() - t1
+        print('{:>10d} {:8.2f} s {:10.3g} samples/s (start-up {:.2f} s)'.format(
+            processes, dt, n_total / dt, t1 - t0))
+        processes *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -5,8 +5,18 @@ Make the numpy data files that are used by ska_tdb.  From the repo root director
 
 $ ./make_tdb.py
 
-This creates files in ./data/p0<VERSION>/. A new TDB directory here should then be
-copied to ``/proj/sot/ska/data/Ska.tdb/`` on HEAD and GRETA.
+This creates files in ./data/p0<VERSION>/, including calibration lookup tables in
+./data/p0<VERSION>/cal_lut/. A new TDB directory here should then be
+copied to ``/proj/sot/ska/data/Ska.tdb/`` on HEAD and GRETA, and the date when the
+new version became effective added to ``/proj/sot/ska/data/Ska.tdb/version_dates.txt``
+(one ``<version> <date>`` line per version) for ``get_tdb_version_at()``.
+
+Each new version is checked with ska_tdb.validate (the same checks as
+``python -m ska_tdb.validate_cli``) and is removed again if any problems are found.
+If the problems are known to be harmless use ``--warn-only`` to just print them, or
+``--no-validate`` to skip the checks:
+
+$ ./make_tdb.py --warn-only
 
 This requires that directories be in /proj/sot/ska/ops/TDB which are the '*.txt' files
 that have been created by CXCDS from the MSFC-1949 files.  These are normally supplied
@@ -20,14 +30,26 @@ from __future__ import print_function
 
 import os
 import glob
+import shutil
+import argparse
 
 import numpy as np
 from astropy.io import ascii
 
+from ska_tdb.calib import write_cal_luts
+from ska_tdb.validate import validate_tdb
+
 TDB_ROOT = '/proj/sot/ska/ops/TDB'
 
 names = 'tcntr tes tlmt tloc tmsrment towner tpc tpp tsc tsmpl tstream ttdm_fmt ttdm'.split()
 
+parser = argparse.ArgumentParser(description='Make ska_tdb numpy data files')
+parser.add_argument('--warn-only', action='store_true',
+                    help='Print validation problems but keep the new TDB version')
+parser.add_argument('--no-validate', action='store_true',
+                    help='Do not validate new TDB versions')
+opt = parser.parse_args()
+
 TDB_versions = [os.path.basename(x) for x in glob.glob(os.path.join(TDB_ROOT, 'p0??'))]
 
 for TDB_version in sorted(TDB_versions):
@@ -78,3 +100,16 @@ for TDB_version in sorted(TDB_versions):
         print()
 
         np.save(os.path.join(out_path, name + '.npy'), dat)
+
+    # Check the new version for inconsistent input rows before accepting it
+    problems = [] if opt.no_validate else validate_tdb(out_path)
+    for problem in problems:
+        print(problem)
+    if problems and not opt.warn_only:
+        shutil.rmtree(out_path)
+        raise Exception('TDB version {} failed validation with {} problem(s)'
+                        .format(TDB_version, len(problems)))
+
+    # Precompute raw => engineering value lookup tables for calibrate()
+    n_luts = write_cal_luts(out_path)
+    print('Wrote {} calibration lookup tables'.format(n_luts))
@@ -2,6 +2,9 @@
 import ska_helpers
 
 from .tdb import *
+from .calib import *
+from .parallel import *
+from .validate import *
 
 __version__ = ska_helpers.get_version('ska_tdb')
 
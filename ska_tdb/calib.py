@@ -0,0 +1,497 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""Calibrate raw telemetry counts to engineering values using the TDB.
+
+Point-pair (``tpp``) and polynomial (``tpc``) calibrations are supported.  For
+MSIDs with a small integer raw count range the full raw to engineering value
+lookup table (LUT) can be precomputed so that calibration is a single
+``np.take``.  LUTs for a TDB version are written to the ``cal_lut``
+sub-directory of the version data with ``write_cal_luts()`` and are then
+memory-mapped on demand.
+
+State codes (``tsc``) are decoded with ``decode_states()``, and large raw
+archives can be processed chunk by chunk with ``iter_calibrate()``.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from . import tdb
+
+__all__ = ['calibrate', 'decode_states', 'iter_calibrate', 'get_cal_lut',
+           'write_cal_luts']
+
+# Largest raw count range (HIGH_RAW_COUNT - LOW_RAW_COUNT + 1) that gets a LUT
+MAX_LUT_LENGTH = 65536
+
+# Calibration types that are handled with a LUT
+LUT_CAL_TYPES = ('PP', 'PC')
+
+# Default number of samples per chunk when iter_calibrate() splits an array
+CHUNK_SIZE = 1000000
+
+# Persisted LUT stores (index dict, values memmap), keyed by data_dir
+_LUT_STORES = {}
+
+# TDB tables and converters by (msid, cal_set) for iter_calibrate() in a worker process
+_WORKER_TABLES = None
+_WORKER_CONVERTERS = {}
+
+
+def calibrate(msid, raw, cal_set=None, use_lut=True, times=None):
+    """Calibrate ``raw`` telemetry counts for ``msid`` to engineering values.
+
+    MSIDs with point-pair (``PP``) or polynomial (``PC``) calibration are
+    converted using the ``tpp`` or ``tpc`` table, while all other MSIDs are
+    returned unchanged as float values.
+
+    Examples
+    --------
+
+    >>> from ska_tdb import calibrate
+    >>> calibrate('tephin', [0, 28, 255])
+    array([ 215.03   ,  135.846  , -103.49045])
+
+    Parameters
+    ----------
+    msid: str
+        MSID name (case-insensitive)
+    raw: array-like
+        Raw telemetry counts
+    cal_set: int
+        Calibration set number (default is CALIBRATION_DEFAULT_SET_NUM)
+    use_lut: bool
+        Use the persisted lookup table for integer ``raw`` if available (default=True)
+    times: CxoTime-compatible times
+        Times of ``raw`` samples, to calibrate each sample with the TDB version in
+        effect at that time (default is the current TDB version for all samples)
+
+    Returns
+    -------
+    ndarray
+        Engineering values
+    """
+    msid = msid.upper()
+    raw = np.asarray(raw)
+    if times is not None:
+        return _per_version(times, raw,
+                            lambda tables, raw: _calibrate(tables, msid, raw, cal_set, use_lut))
+    return _calibrate(tdb.tables, msid, raw, cal_set, use_lut)
+
+
+def decode_states(msid, raw, cal_set=None, times=None):
+    """Decode ``raw`` telemetry counts for ``msid`` to state codes using ``tsc``.
+
+    Raw counts that are not in any of the state code ranges are returned as an
+    empty string.
+
+    Examples
+    --------
+
+    >>> from ska_tdb import decode_states
+    >>> decode_states('aopcadmd', [0, 1, 6])
+    array(['STBY', 'NPNT', 'NULL'], dtype='<U4')
+
+    Parameters
+    ----------
+    msid: str
+        MSID name (case-insensitive)
+    raw: array-like
+        Raw telemetry counts
+    cal_set: int
+        Calibration set number (default is CALIBRATION_DEFAULT_SET_NUM)
+    times: CxoTime-compatible times
+        Times of ``raw`` samples, to decode each sample with the TDB version in
+        effect at that time (default is the current TDB version for all samples)
+
+    Returns
+    -------
+    ndarray
+        State codes
+    """
+    msid = msid.upper()
+    raw = np.asarray(raw)
+    if times is not None:
+        return _per_version(times, raw,
+                            lambda tables, raw: _decode_states(tables, msid, raw, cal_set))
+    return _decode_states(tdb.tables, msid, raw, cal_set)
+
+
+def iter_calibrate(chunks, msid=None, cal_set=None, chunk_size=CHUNK_SIZE, processes=None):
+    """Calibrate or state-decode raw telemetry counts chunk by chunk.
+
+    This allows processing raw archives that are too large to hold in memory,
+    along with the calibrated output.  The TDB calibration for each MSID is
+    resolved once and then applied to every chunk.  MSIDs with state codes in
+    ``tsc`` are decoded to state code strings and all others are calibrated to
+    engineering values as for ``calibrate()``.
+
+    The ``chunks`` argument can be any of:
+
+    - Iterable of dicts of raw count arrays keyed by MSID.
+    - Iterable of raw count arrays for ``msid``.
+    - Array of raw counts for ``msid``, e.g. from ``np.load(file, mmap_mode='r')``,
+      which is split into chunks of ``chunk_size`` samples.
+    - Structured array with one raw count column per MSID, split in the same way.
+
+    Examples
+    --------
+
+    >>> raw = np.load('tephin_raw.npy', mmap_mode='r')
+    >>> for eng in iter_calibrate(raw, msid='tephin'):
+    ...     process(eng)
+
+    >>> raw = np.load('pcad_raw.npy', mmap_mode='r')  # columns AOPCADMD, AOACASEQ
+    >>> for out in iter_calibrate(raw, processes=4):
+    ...     process(out['AOPCADMD'], out['AOACASEQ'])
+
+    Parameters
+    ----------
+    chunks: iterable, ndarray
+        Raw count chunks
+    msid: str
+        MSID name for chunks that are plain arrays
+    cal_set: int, dict
+        Calibration set number, or dict of calibration set numbers by MSID
+        (default is CALIBRATION_DEFAULT_SET_NUM)
+    chunk_size: int
+        Number of samples per chunk when ``chunks`` is an array
+    processes: int
+        Number of worker processes for converting MSIDs in parallel (default=None
+        for no worker processes)
+
+    Yields
+    ------
+    ndarray, dict
+        Output values for each chunk, as an array if ``msid`` was given or else as
+        a dict of arrays keyed by MSID
+    """
+    if isinstance(chunks, np.ndarray):
+        raw_array = chunks
+        chunks = (raw_array[i0:i0 + chunk_size]
+                  for i0 in range(0, len(raw_array), chunk_size))
+
+    if isinstance(cal_set, dict):
+        cal_sets = {name.upper(): val for name, val in cal_set.items()}
+    else:
+        cal_sets = None
+
+    converters = {}
+    pool = None
+    try:
+        for chunk in chunks:
+            as_array = False
+            if isinstance(chunk, np.ndarray) and chunk.dtype.names:
+                chunk = {name: chunk[name] for name in chunk.dtype.names}
+            elif not isinstance(chunk, dict):
+                if msid is None:
+                    raise ValueError('msid must be given for chunks that are not dicts')
+                chunk = {msid: chunk}
+                as_array = True
+
+            # MSID and calibration set for each chunk key
+            keys = {name: (name.upper(),
+                           cal_set if cal_sets is None else cal_sets.get(name.upper()))
+                    for name in chunk}
+
+            if not processes:
+                for key in keys.values():
+                    if key not in converters:
+                        converters[key] = _get_converter(tdb.tables, *key)
+                out = {name: converters[keys[name]](raw) for name, raw in chunk.items()}
+            else:
+                # One pool for all chunks, where each worker resolves the converter
+                # for an MSID the first time it gets that MSID.
+                if pool is None:
+                    pool = ProcessPoolExecutor(processes, initializer=_init_converters,
+                                               initargs=(tdb.tables.data_dir,))
+                futures = {name: pool.submit(_convert, keys[name], raw)
+                           for name, raw in chunk.items()}
+                out = {name: future.result() for name, future in futures.items()}
+
+            yield out[msid] if as_array else out
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+def _init_converters(data_dir):
+    """Set the TDB tables for ``iter_calibrate()`` in a worker process."""
+    global _WORKER_TABLES
+    _WORKER_TABLES = tdb.TableDict(data_dir)
+    _WORKER_CONVERTERS.clear()
+
+
+def _convert(key, raw):
+    """Convert ``raw`` in a worker with the converter for ``key`` = (msid, cal_set)."""
+    if key not in _WORKER_CONVERTERS:
+        _WORKER_CONVERTERS[key] = _get_converter(_WORKER_TABLES, *key)
+    return _WORKER_CONVERTERS[key](raw)
+
+
+def get_cal_lut(msid, cal_set=None):
+    """Get the raw to engineering value lookup table for ``msid``.
+
+    The LUT is taken from the memory-mapped ``cal_lut`` files for the current TDB
+    version if those exist, otherwise it is computed (and not cached).
+
+    Parameters
+    ----------
+    msid: str
+        MSID name (case-insensitive)
+    cal_set: int
+        Calibration set number (default is CALIBRATION_DEFAULT_SET_NUM)
+
+    Returns
+    -------
+    tuple, None
+        (low_raw_count, values) where ``values[i]`` is the engineering value for
+        raw count ``low_raw_count + i``, or None if ``msid`` has no LUT
+    """
+    msid = msid.upper()
+    cal_type, cal_set = _cal_info(tdb.tables, msid, cal_set)
+    return _get_cal_lut(tdb.tables, msid, cal_type, cal_set, compute=True)
+
+
+def write_cal_luts(data_dir=None):
+    """Compute lookup tables for all eligible MSIDs and write to ``data_dir``.
+
+    The LUTs are written to ``<data_dir>/cal_lut/index.npy`` (MSID, calibration
+    set, low raw count, offset and length of each LUT) and
+    ``<data_dir>/cal_lut/values.npy`` (all LUT values concatenated).
+
+    Parameters
+    ----------
+    data_dir: str
+        TDB version directory (default is the current TDB version)
+
+    Returns
+    -------
+    int
+        Number of LUTs written
+    """
+    tables = tdb.TableDict(data_dir)
+    tmsrment = tables['tmsrment']
+    cands = tmsrment.where(calibration_type=list(LUT_CAL_TYPES))
+    n_raws = cands['HIGH_RAW_COUNT'] - cands['LOW_RAW_COUNT'] + 1
+    cands = cands['MSID'][(n_raws > 0) & (n_raws <= MAX_LUT_LENGTH)]
+
+    index = []
+    values = []
+    offset = 0
+    for msid in cands:
+        row = tmsrment[msid]
+        cal_table = tables['tpp' if row['CALIBRATION_TYPE'] == 'PP' else 'tpc']
+        for cal_set in np.unique(cal_table.where(msid=msid)['CALIBRATION_SET_NUM']):
+            lut = _make_lut(tables, msid, row['CALIBRATION_TYPE'], cal_set)
+            low_raw_count, vals = lut
+            index.append((msid, cal_set, low_raw_count, offset, len(vals)))
+            values.append(vals)
+            offset += len(vals)
+
+    index = np.array(index, dtype=[('MSID', 'U15'), ('CALIBRATION_SET_NUM', 'i8'),
+                                   ('LOW_RAW_COUNT', 'i8'), ('OFFSET', 'i8'),
+                                   ('LENGTH', 'i8')])
+    values = np.concatenate(values) if values else np.zeros(0, dtype=np.float64)
+
+    out_dir = os.path.join(tables.data_dir, 'cal_lut')
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
+    np.save(os.path.join(out_dir, 'index.npy'), index)
+    np.save(os.path.join(out_dir, 'values.npy'), values)
+    _LUT_STORES.pop(tables.data_dir, None)
+
+    return len(index)
+
+
+def _calibrate(tables, msid, raw, cal_set, use_lut):
+    """Calibrate ``raw`` for ``msid`` using ``tables``."""
+    cal_type, cal_set = _cal_info(tables, msid, cal_set)
+
+    if use_lut and raw.dtype.kind in 'iu':
+        lut = _get_cal_lut(tables, msid, cal_type, cal_set)
+        if lut is not None:
+            return _take_lut(lut, raw, lambda raw: _calibrate_raw(tables, msid, cal_type,
+                                                                  cal_set, raw))
+
+    return _calibrate_raw(tables, msid, cal_type, cal_set, raw)
+
+
+def _take_lut(lut, raw, calibrator):
+    """Calibrate integer ``raw`` with ``lut``, using ``calibrator`` outside the LUT range."""
+    low_raw_count, vals = lut
+    # Offset in int64 so narrow raw dtypes (e.g. uint8) cannot wrap around
+    idx = raw.astype(np.int64) - low_raw_count
+    # np.asarray since np.take returns a numpy scalar for scalar ``raw``
+    out = np.asarray(np.take(vals, idx, mode='clip'))
+    outside = (idx < 0) | (idx >= len(vals))
+    if np.any(outside):
+        out[outside] = calibrator(raw[outside])
+    return out
+
+
+def _decode_states(tables, msid, raw, cal_set):
+    """Decode ``raw`` for ``msid`` to state codes using ``tables``."""
+    _, cal_set = _cal_info(tables, msid, cal_set)
+    return _StateDecoder(tables, msid, cal_set)(raw)
+
+
+def _per_version(times, raw, func):
+    """Apply ``func(tables, raw)`` to segments of ``raw`` by TDB version at ``times``."""
+    versions = np.broadcast_to(tdb.get_tdb_version_at(times), raw.shape)
+    parts = []
+    for version in np.unique(versions):
+        ok = versions == version
+        parts.append((ok, func(tdb.get_tdb_tables(version), raw[ok])))
+    if not parts:
+        return func(tdb.tables, raw)
+
+    out = np.empty(raw.shape, dtype=np.result_type(*[vals for ok, vals in parts]))
+    for ok, vals in parts:
+        out[ok] = vals
+    return out
+
+
+def _get_cal_lut(tables, msid, cal_type, cal_set, compute=False):
+    """Return persisted LUT for ``msid`` using ``tables``.
+
+    If there are no persisted LUTs then return a newly computed LUT if ``compute``
+    is True, otherwise None.
+    """
+    store = _get_lut_store(tables.data_dir)
+    if store is not None:
+        return store.get((msid, cal_set))
+    return _make_lut(tables, msid, cal_type, cal_set) if compute else None
+
+
+def _get_converter(tables, msid, cal_set=None):
+    """Return a callable that converts raw counts for ``msid`` using ``tables``."""
+    msid = msid.upper()
+    cal_type, cal_set = _cal_info(tables, msid, cal_set)
+
+    if len(tables['tsc'].where(msid=msid, calibration_set_num=cal_set)) > 0:
+        return _StateDecoder(tables, msid, cal_set)
+
+    if cal_type in LUT_CAL_TYPES:
+        if cal_type == 'PP':
+            calibrator = _PointPairCalibrator(tables, msid, cal_set)
+        else:
+            calibrator = _PolyCalibrator(tables, msid, cal_set)
+        # A computed LUT is only kept by the converter, and pays off over the chunks
+        lut = _get_cal_lut(tables, msid, cal_type, cal_set, compute=True)
+        if lut is not None:
+            calibrator = _LutCalibrator(lut, calibrator)
+        return calibrator
+
+    return _float_values
+
+
+class _LutCalibrator(object):
+    """Calibrate integer raw counts with a LUT and others with ``calibrator``."""
+    def __init__(self, lut, calibrator):
+        self.lut = lut
+        self.calibrator = calibrator
+
+    def __call__(self, raw):
+        raw = np.asarray(raw)
+        if raw.dtype.kind in 'iu':
+            return _take_lut(self.lut, raw, self.calibrator)
+        return self.calibrator(raw)
+
+
+class _PointPairCalibrator(object):
+    """Calibrate raw counts by interpolating ``tpp`` point pairs."""
+    def __init__(self, tables, msid, cal_set):
+        pps = tables['tpp'].where(msid=msid, calibration_set_num=cal_set)
+        if len(pps) == 0:
+            raise ValueError('No tpp calibration set {} for {}'.format(cal_set, msid))
+        order = np.argsort(pps['RAW_COUNT'], kind='stable')
+        self.raw_counts = pps['RAW_COUNT'][order]
+        self.eng_vals = pps['ENG_UNIT_VALUE'][order]
+
+    def __call__(self, raw):
+        return np.interp(raw, self.raw_counts, self.eng_vals)
+
+
+class _PolyCalibrator(object):
+    """Calibrate raw counts with ``tpc`` polynomial coefficients."""
+    def __init__(self, tables, msid, cal_set):
+        pcs = tables['tpc'].where(msid=msid, calibration_set_num=cal_set)
+        if len(pcs) == 0:
+            raise ValueError('No tpc calibration set {} for {}'.format(cal_set, msid))
+        pc = pcs.data[0]
+        self.coefs = [pc['COEF{}'.format(i)] for i in range(pc['DEG'] + 1)]
+
+    def __call__(self, raw):
+        return np.polynomial.polynomial.polyval(np.asarray(raw, dtype=np.float64), self.coefs)
+
+
+class _StateDecoder(object):
+    """Decode raw counts to ``tsc`` state codes."""
+    def __init__(self, tables, msid, cal_set):
+        scs = tables['tsc'].where(msid=msid, calibration_set_num=cal_set)
+        order = np.argsort(scs['LOW_RAW_COUNT'], kind='stable')
+        self.low_raw_counts = scs['LOW_RAW_COUNT'][order]
+        self.high_raw_counts = scs['HIGH_RAW_COUNT'][order]
+        self.state_codes = scs['STATE_CODE'][order]
+
+    def __call__(self, raw):
+        raw = np.asarray(raw)
+        if len(self.state_codes) == 0:
+            return np.zeros(raw.shape, dtype=self.state_codes.dtype)
+        idx = np.searchsorted(self.low_raw_counts, raw, side='right') - 1
+        ok = (idx >= 0) & (raw <= self.high_raw_counts[idx.clip(0)])
+        return np.where(ok, self.state_codes[idx.clip(0)], '')
+
+
+def _float_values(raw):
+    """Uncalibrated MSID values are just the raw counts as float."""
+    return np.asarray(raw, dtype=np.float64)
+
+
+def _get_lut_store(data_dir):
+    """Return dict of persisted LUTs for ``data_dir`` or None if not available."""
+    if data_dir not in _LUT_STORES:
+        lut_dir = os.path.join(data_dir, 'cal_lut')
+        try:
+            index = np.load(os.path.join(lut_dir, 'index.npy'))
+            values = np.load(os.path.join(lut_dir, 'values.npy'), mmap_mode='r')
+        except IOError:
+            store = None
+        else:
+            # np.asarray gives plain ndarray views (not memmap) of the mapped file
+            store = {(msid, cal_set): (low, np.asarray(values[offset:offset + length]))
+                     for msid, cal_set, low, offset, length in index.tolist()}
+        _LUT_STORES[data_dir] = store
+    return _LUT_STORES[data_dir]
+
+
+def _cal_info(tables, msid, cal_set):
+    """Return (calibration type, calibration set) for ``msid``."""
+    row = tables['tmsrment'][msid]
+    if not isinstance(row.data, np.void):
+        raise KeyError('No MSID {} in TDB'.format(msid))
+    if cal_set is None:
+        cal_set = row['CALIBRATION_DEFAULT_SET_NUM']
+    return row['CALIBRATION_TYPE'], int(cal_set)
+
+
+def _make_lut(tables, msid, cal_type, cal_set):
+    """Compute LUT for ``msid`` or return None if not eligible."""
+    row = tables['tmsrment'][msid]
+    low_raw_count = int(row['LOW_RAW_COUNT'])
+    n_raw = int(row['HIGH_RAW_COUNT']) - low_raw_count + 1
+    if cal_type not in LUT_CAL_TYPES or not 0 < n_raw <= MAX_LUT_LENGTH:
+        return None
+
+    raw = np.arange(low_raw_count, low_raw_count + n_raw)
+    return low_raw_count, _calibrate_raw(tables, msid, cal_type, cal_set, raw)
+
+
+def _calibrate_raw(tables, msid, cal_type, cal_set, raw):
+    """Calibrate ``raw`` directly from the ``tpp`` or ``tpc`` table."""
+    if cal_type == 'PP':
+        return _PointPairCalibrator(tables, msid, cal_set)(raw)
+    if cal_type == 'PC':
+        return _PolyCalibrator(tables, msid, cal_set)(raw)
+    return _float_values(raw)
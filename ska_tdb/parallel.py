@@ -0,0 +1,137 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""Process pool for running per-MSID work in parallel with shared TDB tables.
+
+Worker processes do not reload and re-convert the TDB tables.  Instead the
+tables of the current TDB version (already converted to unicode) and their MSID
+indexes are written once to a temporary directory, and each worker
+memory-maps those files.  The operating system page cache then shares a single
+copy of the tables between all the workers.
+"""
+import os
+import glob
+import shutil
+import weakref
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from . import tdb
+from . import calib
+
+__all__ = ['MsidPool']
+
+
+class MsidPool(object):
+    """Pool of worker processes for per-MSID work using the current TDB version.
+
+    Any module-level (picklable) function can be mapped over MSIDs, for instance
+    ``calibrate``, ``decode_states`` or a user function which looks at
+    ``ska_tdb.msids``.  Within the workers the ``ska_tdb.tdb`` module ``tables``
+    and ``msids`` variables use the shared memory-mapped tables.
+
+    Examples
+    --------
+
+    >>> from ska_tdb import MsidPool, calibrate, tables
+    >>> names = tables['tmsrment'].where(calibration_type='PP')['MSID']
+    >>> raws = [np.arange(256)] * len(names)
+    >>> with MsidPool(processes=8) as pool:
+    ...     engs = pool.map(calibrate, names, raws)
+
+    Parameters
+    ----------
+    processes: int
+        Number of worker processes (default is the number of CPUs)
+    """
+    def __init__(self, processes=None):
+        self.processes = processes or os.cpu_count() or 1
+        self.share_dir = tempfile.mkdtemp(prefix='ska_tdb_')
+        try:
+            _write_shared_tables(self.share_dir)
+            self._executor = ProcessPoolExecutor(
+                self.processes, initializer=_init_worker,
+                initargs=(self.share_dir, tdb.DATA_DIR, tdb.TDB_VERSION))
+        except Exception:
+            shutil.rmtree(self.share_dir, ignore_errors=True)
+            raise
+        # Release workers and shared files also if the pool is never closed
+        self._finalizer = weakref.finalize(self, _cleanup, self._executor, self.share_dir)
+
+    def map(self, func, msids, *iterables, **kwargs):
+        """Return ``[func(msid, *args) for msid, *args in zip(msids, *iterables)]``.
+
+        The calls are run in the worker processes, with MSIDs sent to the workers
+        in chunks to reduce the scheduling overhead for short calls.
+
+        Parameters
+        ----------
+        func: callable
+            Module-level function taking an MSID as the first argument
+        msids: list
+            MSID names
+        *iterables:
+            Additional arguments for ``func``, one item per MSID
+        chunksize: int
+            Number of MSIDs per chunk (default gives about four chunks per worker)
+
+        Returns
+        -------
+        list
+            Results of ``func`` for each MSID
+        """
+        msids = list(msids)
+        chunksize = kwargs.pop('chunksize', None)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments {}'.format(sorted(kwargs)))
+        if chunksize is None:
+            chunksize = max(1, -(-len(msids) // (self.processes * 4)))
+        return list(self._executor.map(func, msids, *iterables, chunksize=chunksize))
+
+    def close(self):
+        """Shut down the worker processes and remove the shared table files."""
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _cleanup(executor, share_dir):
+    """Shut down ``executor`` and remove ``share_dir``."""
+    executor.shutdown()
+    shutil.rmtree(share_dir, ignore_errors=True)
+
+
+def _write_shared_tables(share_dir):
+    """Write current TDB tables and MSID indexes as unicode .npy files."""
+    os.mkdir(os.path.join(share_dir, 'indexes'))
+    for name in tdb.tables.keys():
+        table = tdb.tables[name]
+        np.save(os.path.join(share_dir, name + '.npy'), table.data)
+        if 'MSID' in table.colnames:
+            table._index('MSID')
+        for colname, (sorted_vals, order) in table._indexes.items():
+            index_file = os.path.join(share_dir, 'indexes', '{}.{}'.format(name, colname))
+            np.save(index_file + '.vals.npy', sorted_vals)
+            np.save(index_file + '.order.npy', order)
+
+
+def _init_worker(share_dir, data_dir, version):
+    """Point the worker ``tables`` and ``msids`` at the shared table files."""
+    tables = tdb.TableDict(share_dir, mmap_mode='r')
+    for filename in glob.glob(os.path.join(share_dir, 'indexes', '*.vals.npy')):
+        name, colname = os.path.basename(filename).split('.')[:2]
+        tables[name]._indexes[colname] = (
+            np.load(filename, mmap_mode='r'),
+            np.load(filename.replace('.vals.npy', '.order.npy'), mmap_mode='r'))
+
+    tdb.TDB_VERSION = version
+    tdb.DATA_DIR = data_dir
+    tdb.tables = tables
+    tdb.msids = tdb.MsidView()
+
+    # Use any persisted calibration LUTs from the original version directory
+    calib._LUT_STORES[share_dir] = calib._get_lut_store(data_dir)
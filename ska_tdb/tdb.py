@@ -12,11 +12,16 @@ import numpy as np
 import six
 
 __all__ = ['msids', 'tables', 'set_tdb_version', 'get_tdb_version',
-           'TableView', 'MsidView']
+           'get_tdb_version_at', 'get_tdb_tables', 'TableView', 'MsidView']
 
 
 SKA = os.environ.get('SKA', os.path.join(os.sep, 'proj', 'sot', 'ska'))
 
+# File with the date each TDB version became effective, one "<version> <date>"
+# line per version, e.g. "14 2016:123:00:00:00.000".  Lines starting with "#"
+# are comments.
+VERSION_DATES_FILE = os.path.join(SKA, 'data', 'Ska.tdb', 'version_dates.txt')
+
 # Set None values for module globals that are set in set_tdb_version
 TDB_VERSIONS = None
 TDB_VERSION = None
@@ -24,6 +29,10 @@ DATA_DIR = None
 tables = None
 msids = None
 
+# Cached TableDict for each TDB version and (times, versions) version timeline
+_version_tables = {}
+_version_timeline = None
+
 # Tables with MSID column.  Might not be complete.
 MSID_TABLES = ['tmsrment', 'tpc', 'tsc', 'tpp', 'tlmt', 'tcntr',
                'tsmpl', 'tloc']
@@ -51,6 +60,15 @@ TMSRMENT_COLS = """
                 EHS_HEADER_FLAG
                 """.lower().split()
 
+# Comparison operators allowed as ``<column>__<op>`` keywords in TableView.where()
+QUERY_OPS = ('eq', 'ne', 'lt', 'le', 'gt', 'ge')
+
+# Maximum number of compiled queries that are cached for each table
+QUERY_CACHE_SIZE = 256
+
+# Default maximum number of MSIDs returned by MsidView.complete()
+COMPLETE_LIMIT = 20
+
 
 def set_tdb_version(version=None):
     """
@@ -62,12 +80,11 @@ def set_tdb_version(version=None):
         TDB version (integer or None => latest)
     """
     global TDB_VERSION
-    global TDB_VERSIONS
     global DATA_DIR
     global tables
     global msids
-    version_dirs = glob.glob(os.path.join(SKA, 'data', 'Ska.tdb', 'p0??'))
-    TDB_VERSIONS = sorted([int(os.path.basename(vdir)[2:]) for vdir in version_dirs])
+    if TDB_VERSIONS is None or version not in TDB_VERSIONS:
+        _find_tdb_versions()
 
     if version is None:
         if TDB_VERSIONS:
@@ -79,10 +96,19 @@ def set_tdb_version(version=None):
 
     TDB_VERSION = version
     DATA_DIR = os.path.join(SKA, 'data', 'Ska.tdb', 'p{:03d}'.format(TDB_VERSION))
-    tables = TableDict()
+    if version not in _version_tables:
+        _version_tables[version] = TableDict(DATA_DIR)
+    tables = _version_tables[version]
     msids = MsidView()
 
 
+def _find_tdb_versions():
+    """Set ``TDB_VERSIONS`` from the version directories in the TDB data area."""
+    global TDB_VERSIONS
+    version_dirs = glob.glob(os.path.join(SKA, 'data', 'Ska.tdb', 'p0??'))
+    TDB_VERSIONS = sorted([int(os.path.basename(vdir)[2:]) for vdir in version_dirs])
+
+
 def get_tdb_version():
     """
     Get the version of the TDB which is used, e.g. 10.
@@ -90,19 +116,103 @@ def get_tdb_version():
     return TDB_VERSION
 
 
+def get_tdb_tables(version):
+    """
+    Get the tables for TDB ``version`` without changing the current version.
+
+    The returned ``TableDict`` is cached so that tables (and their indexes) for
+    each version are only loaded once.
+
+    Parameters
+    ----------
+    version: int
+        TDB version
+
+    Returns
+    -------
+    TableDict
+        Tables for ``version``, like the module ``tables`` variable
+    """
+    if TDB_VERSIONS is None or version not in TDB_VERSIONS:
+        # Version may have been installed since the versions were last found
+        _find_tdb_versions()
+    if version not in TDB_VERSIONS:
+        raise ValueError('TDB version must be one of the following: {}'.format(TDB_VERSIONS))
+    if version not in _version_tables:
+        _version_tables[version] = TableDict(
+            os.path.join(SKA, 'data', 'Ska.tdb', 'p{:03d}'.format(version)))
+    return _version_tables[version]
+
+
+def get_tdb_version_at(times):
+    """
+    Get the TDB version that was in effect at ``times``.
+
+    The effective date of each version is read from ``VERSION_DATES_FILE``.
+
+    Examples
+    --------
+
+    >>> get_tdb_version_at('2012:001')
+    10
+    >>> get_tdb_version_at(['2012:001', '2020:001'])
+    array([10, 14])
+
+    Parameters
+    ----------
+    times: CxoTime-compatible time(s)
+        Time or array of times (any format accepted by ``CxoTime``)
+
+    Returns
+    -------
+    int, ndarray
+        TDB version for each time
+    """
+    from cxotime import CxoTime
+
+    global _version_timeline
+    if _version_timeline is None:
+        versions = []
+        dates = []
+        with open(VERSION_DATES_FILE, 'r') as fh:
+            for line in fh:
+                vals = line.split()
+                if vals and not vals[0].startswith('#'):
+                    versions.append(int(vals[0]))
+                    dates.append(vals[1])
+        secs = CxoTime(dates).secs
+        order = np.argsort(secs, kind='stable')
+        _version_timeline = secs[order], np.array(versions)[order]
+
+    version_secs, versions = _version_timeline
+    secs = CxoTime(times).secs
+    idx = np.searchsorted(version_secs, secs, side='right') - 1
+    if np.any(idx < 0):
+        raise ValueError('Time(s) before the first TDB version effective date')
+    out = versions[idx]
+    return int(out) if np.ndim(out) == 0 else out
+
+
 class TableDict(dict):
+    def __init__(self, data_dir=None, mmap_mode=None):
+        super(TableDict, self).__init__()
+        # Directory with the table files, defaulting to the current TDB version
+        self.data_dir = DATA_DIR if data_dir is None else data_dir
+        # Memory-map table files instead of reading (see np.load)
+        self.mmap_mode = mmap_mode
+
     def __getitem__(self, item):
         if item not in self:
             try:
-                filename = os.path.join(DATA_DIR, item + '.npy')
-                self[item] = TableView(np.load(filename))
+                filename = os.path.join(self.data_dir, item + '.npy')
+                self[item] = TableView(np.load(filename, mmap_mode=self.mmap_mode))
             except IOError:
                 raise KeyError("Table {} not in TDB files (no file {})".format(item, filename))
         return dict.__getitem__(self, item)
 
     def keys(self):
         import glob
-        files = glob.glob(os.path.join(DATA_DIR, '*.npy'))
+        files = glob.glob(os.path.join(self.data_dir, '*.npy'))
         return [os.path.basename(x)[:-4] for x in files]
 
 
@@ -199,9 +309,15 @@ class TableView(object):
           dtype=[('MSID', '<U14'), ('CALIBRATION_SET_NUM', '<i8'), ('SEQUENCE_NUM', '<i8'), ('RAW_COUNT', '<i8'), ('ENG_UNIT_VALUE', '<f8')])
     """
     def __init__(self, data):
-        if six.PY2 or isinstance(data, np.void):
+        # Sorted column indexes and compiled query results, built on demand
+        self._indexes = {}
+        self._query_cache = {}
+
+        if (six.PY2 or isinstance(data, np.void)
+                or not any(data.dtype[name].kind == 'S' for name in data.dtype.names)):
             # np.void case is when TableView is passed a table row, in which case
-            # it has already been converted to string.
+            # it has already been converted to string.  Likewise a selection from
+            # an existing table has no bytes columns left to convert.
             self.data = data
 
         else:
@@ -222,14 +338,125 @@ class TableView(object):
             item = item.upper()
             if (item not in self.data.dtype.names
                     and 'MSID' in self.data.dtype.names):
-                ok = self.data['MSID'] == item
-                new_data = self.data[ok]
+                new_data = self.data[self._rows_equal('MSID', [item])]
                 if len(new_data) == 1:
                     new_data = new_data[0]
                 return TableView(new_data)
 
         return self.data[item]
 
+    def where(self, **kwargs):
+        """Select table rows matching all of the column conditions in ``kwargs``.
+
+        Each keyword is a column name (case-insensitive), optionally followed by
+        ``__<op>`` where ``<op>`` is one of ``eq`` (default), ``ne``, ``lt``,
+        ``le``, ``gt`` or ``ge``.  For ``eq`` and ``ne`` the value can be a list
+        of allowed values.  MSID values are case-insensitive.
+
+        String and integer columns are matched using a sorted index that is built
+        the first time the column is queried, and the selected rows for each
+        distinct query are cached, so repeated queries are cheap.
+
+        Examples
+        --------
+
+        >>> tmsrment = tables['tmsrment']
+        >>> thm_pp = tmsrment.where(owner_id='THM', calibration_type=['PP', 'PC'])
+        >>> wide = tmsrment.where(high_raw_count__gt=4095, data_type='IUNS')
+
+        Parameters
+        ----------
+        **kwargs:
+            Column conditions, e.g. ``owner_id='THM'`` or ``low_raw_count__ge=0``
+
+        Returns
+        -------
+        TableView
+            Table of matching rows in their original order
+        """
+        predicates = []
+        for key, val in kwargs.items():
+            colname, _, op = key.upper().partition('__')
+            op = op.lower() or 'eq'
+            if colname not in self.colnames:
+                raise ValueError('Table has no column {}'.format(colname))
+            if op not in QUERY_OPS:
+                raise ValueError('Query operator must be one of {}'.format(QUERY_OPS))
+            if op in ('eq', 'ne'):
+                vals = val if isinstance(val, (list, tuple, set, np.ndarray)) else [val]
+                if colname.endswith('MSID'):
+                    vals = [x.upper() for x in vals]
+                try:
+                    val = tuple(sorted(set(vals)))
+                except TypeError:
+                    raise ValueError('Values for column {} must all be the same type'
+                                     .format(colname))
+            elif isinstance(val, (list, tuple, set, np.ndarray)):
+                raise ValueError('Query operator {} requires a scalar value'.format(op))
+            predicates.append((colname, op, val))
+        predicates = tuple(sorted(predicates))
+
+        if predicates not in self._query_cache:
+            if len(self._query_cache) >= QUERY_CACHE_SIZE:
+                del self._query_cache[next(iter(self._query_cache))]
+            self._query_cache[predicates] = self._query_rows(predicates)
+
+        return TableView(self.data[self._query_cache[predicates]])
+
+    def _query_rows(self, predicates):
+        """Return indices of rows satisfying all ``predicates`` from ``where()``."""
+        ok = np.ones(len(self.data), dtype=bool)
+        for colname, op, val in predicates:
+            if self.data.dtype[colname].kind == 'f':
+                # No index for float columns, just compare directly
+                col = self.data[colname]
+                if op in ('eq', 'ne'):
+                    match = np.isin(col, val)
+                    ok &= match if op == 'eq' else ~match
+                else:
+                    ok &= getattr(np, {'lt': 'less', 'le': 'less_equal', 'gt': 'greater',
+                                       'ge': 'greater_equal'}[op])(col, val)
+                continue
+
+            if op in ('eq', 'ne'):
+                rows = self._rows_equal(colname, val)
+            else:
+                rows = self._rows_range(colname, op, val)
+            match = np.zeros(len(self.data), dtype=bool)
+            match[rows] = True
+            ok &= ~match if op == 'ne' else match
+
+        return np.flatnonzero(ok)
+
+    def _index(self, colname):
+        """Return (sorted values, sort order) index for ``colname``."""
+        if colname not in self._indexes:
+            order = np.argsort(self.data[colname], kind='stable')
+            self._indexes[colname] = (self.data[colname][order], order)
+        return self._indexes[colname]
+
+    def _rows_equal(self, colname, vals):
+        """Return sorted indices of rows where ``colname`` is one of ``vals``."""
+        if len(vals) == 0:
+            return np.zeros(0, dtype=np.intp)
+        sorted_vals, order = self._index(colname)
+        vals = np.asarray(vals)
+        i0s = np.searchsorted(sorted_vals, vals, side='left')
+        i1s = np.searchsorted(sorted_vals, vals, side='right')
+        if len(vals) == 1:
+            # Stable sort so rows for a single value are already in table order
+            return order[i0s[0]:i1s[0]]
+        return np.sort(np.concatenate([order[i0:i1] for i0, i1 in zip(i0s, i1s)]))
+
+    def _rows_range(self, colname, op, val):
+        """Return indices of rows where ``colname <op> val`` (unsorted)."""
+        sorted_vals, order = self._index(colname)
+        if op in ('lt', 'ge'):
+            idx = np.searchsorted(sorted_vals, val, side='left')
+        else:
+            idx = np.searchsorted(sorted_vals, val, side='right')
+        return order[:idx] if op in ('lt', 'le') else order[idx:]
+
     @property
     def colnames(self):
         return self.data.dtype.names
@@ -347,12 +574,64 @@ class MsidView(object):
 
         return [msids[x] for x in tables['tmsrment']['MSID'][ok]]
 
+    def complete(self, text, limit=COMPLETE_LIMIT, max_dist=0):
+        """Suggest MSIDs for the partial MSID or technical name ``text``.
+
+        MSIDs starting with ``text`` come first (shortest first), followed by MSIDs
+        with a word in the technical name starting with ``text``.  If ``max_dist``
+        is non-zero these are followed by MSIDs that start with ``text`` to within
+        ``max_dist`` character edits (fewest edits first).  Matching is
+        case-insensitive and uses a sorted index built once per TDB version.
+
+        Examples
+        --------
+
+        >>> msids.complete('teph')
+        ['TEPHIN', 'TEPHTRP1', 'TEPHTRP2', 'TEPHTRR1', 'TEPHTRR2']
+        >>> msids.complete('tepjin', max_dist=1)
+        ['TEPHIN']
+
+        Parameters
+        ----------
+        text: str
+            Partial MSID or technical name word
+        limit: int
+            Maximum number of MSIDs to return (default=20)
+        max_dist: int
+            Maximum edit distance for fuzzy matches (default=0 for no fuzzy matches)
+
+        Returns
+        -------
+        list
+            Matching MSID names
+        """
+        return _get_msid_index().complete(text.upper(), limit, max_dist)
+
     def __getitem__(self, item):
-        if item.upper() in tables['tmsrment']['MSID']:
+        if len(tables['tmsrment']._rows_equal('MSID', [item.upper()])) > 0:
             return MsidView(item)
         else:
             raise KeyError('No MSID {} in TDB'.format(item))
 
+    def __getattr__(self, attr):
+        # Allow ``msids.tephin`` as well as ``msids['tephin']``.  This is only
+        # called for attributes not found normally, so never shadows a column.
+        if attr.startswith('_') or self._msid:
+            raise AttributeError(attr)
+        try:
+            return self[attr]
+        except KeyError:
+            raise AttributeError("'MsidView' object has no attribute '{}'".format(attr))
+
+    def __dir__(self):
+        out = dir(self.__class__) + list(self.__dict__)
+        if not self._msid:
+            out += [x.lower() for x in _get_msid_index().msids if re.match(r'[A-Z_]\w*$', x)]
+        return out
+
+    def _ipython_key_completions_(self):
+        return [] if self._msid else _get_msid_index().msids.tolist()
+
     @staticmethod
     def _get_table_func(tablename):
         def _func(self):
@@ -384,4 +663,85 @@ class MsidView(object):
             return object.__repr__(self)
 
 
+class _MsidIndex(object):
+    """Sorted prefix index of MSIDs and technical name words for ``tmsrment``."""
+    def __init__(self, tmsrment):
+        self.msids = np.sort(tmsrment['MSID'])
+        self.lengths = np.char.str_len(self.msids)
+
+        words = []
+        word_msids = []
+        for msid, name in zip(tmsrment['MSID'], np.char.upper(tmsrment['TECHNICAL_NAME'])):
+            for word in set(name.split()):
+                words.append(word)
+                word_msids.append(msid)
+        order = np.argsort(words, kind='stable')
+        self.words = np.array(words, dtype=tmsrment['TECHNICAL_NAME'].dtype)[order]
+        self.word_msids = np.array(word_msids, dtype=self.msids.dtype)[order]
+
+        # Character codes of each MSID (zero-padded) for fuzzy matching
+        width = self.msids.dtype.itemsize // 4
+        self.codes = self.msids.view(np.uint32).reshape(len(self.msids), width)
+
+    def complete(self, text, limit, max_dist):
+        out = []
+
+        i0, i1 = _prefix_range(self.msids, text)
+        out.extend(_shortest_first(self.msids[i0:i1]))
+
+        if len(out) < limit and text:
+            i0, i1 = _prefix_range(self.words, text)
+            out.extend(_shortest_first(np.unique(self.word_msids[i0:i1])))
+
+        if len(out) < limit and max_dist > 0 and text:
+            # Require at least one matching character, not just edits
+            dists = self._prefix_dists(text)
+            ok = (dists <= max_dist) & (dists < len(text))
+            order = np.lexsort((self.msids[ok], self.lengths[ok], dists[ok]))
+            out.extend(self.msids[ok][order])
+
+        # Remove duplicates while keeping the order
+        seen = set()
+        out = [x for x in out if not (x in seen or seen.add(x))]
+        return [str(x) for x in out[:limit]]
+
+    def _prefix_dists(self, text):
+        """Edit distance between ``text`` and the closest prefix of each MSID."""
+        n_msid, width = self.codes.shape
+        cols = np.arange(width + 1)
+        # dists[:, j] is the edit distance between text[:i] and msid[:j]
+        dists = np.tile(cols, (n_msid, 1))
+        for i, char in enumerate(text, 1):
+            costs = (self.codes != ord(char)).astype(int)
+            new = np.empty_like(dists)
+            new[:, 0] = i
+            new[:, 1:] = np.minimum(dists[:, 1:] + 1, dists[:, :-1] + costs)
+            # Insertions: new[:, j] = min(new[:, j], new[:, j - 1] + 1) for all j
+            dists = np.minimum.accumulate(new - cols, axis=1) + cols
+        dists = np.where(cols <= self.lengths[:, None], dists, len(text) + width)
+        return dists.min(axis=1)
+
+
+def _prefix_range(sorted_vals, prefix):
+    """Return index range of values in ``sorted_vals`` starting with ``prefix``."""
+    if not prefix:
+        return 0, len(sorted_vals)
+    i0 = np.searchsorted(sorted_vals, prefix, side='left')
+    i1 = np.searchsorted(sorted_vals, prefix[:-1] + chr(ord(prefix[-1]) + 1), side='left')
+    return i0, i1
+
+
+def _shortest_first(vals):
+    """Sort ``vals`` by length and then alphabetically."""
+    return vals[np.lexsort((vals, np.char.str_len(vals)))]
+
+
+def _get_msid_index():
+    """Return the MSID prefix index for the current TDB version (built once)."""
+    tmsrment = tables['tmsrment']
+    if not hasattr(tmsrment, '_msid_index'):
+        tmsrment._msid_index = _MsidIndex(tmsrment)
+    return tmsrment._msid_index
+
+
 set_tdb_version()  # Choose the most recent version
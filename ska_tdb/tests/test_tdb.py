@@ -1,5 +1,15 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
-from .. import msids, tables, set_tdb_version, get_tdb_version
+import gc
+import os
+
+import numpy as np
+import pytest
+
+from .. import (msids, tables, set_tdb_version, get_tdb_version, calibrate, get_cal_lut,
+                 decode_states, iter_calibrate, MsidPool, get_tdb_tables, get_tdb_version_at,
+                 validate_tdb)
+from .. import calib, tdb
+from ..tdb import TableDict
 
 # Set to fixed version for regression testing
 TDB_VERSION = 14
@@ -51,3 +61,255 @@ def test_version():
     assert get_tdb_version() == 8
     assert list(msids['tephin'].Tlmt) == ['TEPHIN', 1, 10.0, 81.0, 5.0, 86.0, 0, 5, 'A']
     set_tdb_version(TDB_VERSION)
+
+    # Tables for another version without changing the current version
+    assert list(get_tdb_tables(8)['tlmt']['tephin']) == ['TEPHIN', 1, 10.0, 81.0, 5.0, 86.0,
+                                                         0, 5, 'A']
+    assert get_tdb_tables(8) is get_tdb_tables(8)
+    assert get_tdb_version() == TDB_VERSION
+
+
+def test_version_at(tmp_path, monkeypatch):
+    pytest.importorskip('cxotime')
+    dates_file = tmp_path / 'version_dates.txt'
+    dates_file.write_text(u'# version  date\n'
+                          u'8  2005:001:00:00:00.000\n'
+                          u'14 2016:123:00:00:00.000\n')
+    monkeypatch.setattr(tdb, 'VERSION_DATES_FILE', str(dates_file))
+    monkeypatch.setattr(tdb, '_version_timeline', None)
+
+    with pytest.raises(ValueError):
+        get_tdb_version_at('2004:365:23:59:59.000')
+    assert get_tdb_version_at('2005:001:00:00:00.000') == 8
+    assert get_tdb_version_at('2016:122:23:59:59.000') == 8
+    assert get_tdb_version_at('2016:123:00:00:00.000') == 14
+    assert get_tdb_version_at('2030:001:00:00:00.000') == 14
+    versions = get_tdb_version_at(['2010:001', '2016:123:00:00:00.000', '2005:001'])
+    assert versions.tolist() == [8, 14, 8]
+
+    # Each sample is calibrated with the version in effect at its time
+    raw = np.array([0, 255])
+    times = ['2010:001', '2020:001']
+    engs = calibrate('tephin', raw, times=times)
+    assert np.allclose(engs[0], calibrate_version(8, 'tephin', raw[:1]))
+    assert np.allclose(engs[1], calibrate_version(14, 'tephin', raw[1:]))
+
+
+def calibrate_version(version, msid, raw):
+    set_tdb_version(version)
+    try:
+        return calibrate(msid, raw)
+    finally:
+        set_tdb_version(TDB_VERSION)
+
+
+def test_get_tdb_tables_refinds_versions(monkeypatch):
+    # A version not in the cached TDB_VERSIONS is looked for again on disk
+    monkeypatch.setattr(tdb, 'TDB_VERSIONS', [TDB_VERSION])
+    assert get_tdb_tables(8) is get_tdb_tables(8)
+    assert 8 in tdb.TDB_VERSIONS
+
+
+def test_where():
+    tm = tables['tmsrment']
+    dat = tm.data
+    out = tm.where(owner_id='THM', calibration_type=['PP', 'PC'])
+    ok = (dat['OWNER_ID'] == 'THM') & np.isin(dat['CALIBRATION_TYPE'], ['PP', 'PC'])
+    assert np.all(out.data == dat[ok])
+    assert 'TEPHIN' in out['MSID']
+
+    out = tm.where(low_raw_count__ge=0, high_raw_count__le=255, data_type='IUNS')
+    ok = (dat['LOW_RAW_COUNT'] >= 0) & (dat['HIGH_RAW_COUNT'] <= 255) & (dat['DATA_TYPE'] == 'IUNS')
+    assert np.all(out.data == dat[ok])
+
+    # MSID values are case-insensitive and match the MSID filter
+    out = tables['tpp'].where(msid='tephin')
+    assert np.all(out.data == tables['tpp']['TEPHIN'].data)
+
+    out = tables['tpp'].where(msid__ne='TEPHIN', eng_unit_value__lt=0.0)
+    assert len(out) > 0
+    assert 'TEPHIN' not in out['MSID']
+    assert np.all(out['ENG_UNIT_VALUE'] < 0.0)
+
+    # Empty list of values matches nothing, or everything for __ne
+    assert len(tm.where(owner_id=[])) == 0
+    assert len(tm.where(msid__ne=[])) == len(tm)
+    assert len(tables['tpp'].where(eng_unit_value=[])) == 0
+
+    with pytest.raises(ValueError):
+        tm.where(owner_id=['THM', 1])
+
+
+def test_calibrate():
+    pps = tables['tpp']['tephin']
+    raw = pps['RAW_COUNT']
+    assert np.allclose(calibrate('tephin', raw), pps['ENG_UNIT_VALUE'])
+
+    raw = np.arange(256, dtype=np.uint8)
+    eng = calibrate('tephin', raw)
+    assert np.allclose(eng, calibrate('tephin', raw, use_lut=False))
+    assert np.allclose(eng, calibrate('tephin', raw.astype(float)))
+
+    low_raw_count, vals = get_cal_lut('tephin')
+    assert low_raw_count == 0
+    assert np.allclose(vals, eng)
+
+    # State code MSID has no calibration
+    assert get_cal_lut('aopcadmd') is None
+    assert np.all(calibrate('aopcadmd', [0, 1, 2]) == [0.0, 1.0, 2.0])
+
+    # Raw counts outside LOW_RAW_COUNT to HIGH_RAW_COUNT are not clipped to the LUT
+    raw = np.array([300, 1000])
+    assert np.allclose(calibrate('1cbat', raw), calibrate('1cbat', raw.astype(float)))
+
+    # Scalar raw counts inside and outside the LUT range give 0-d arrays
+    for msid, raw in (('tephin', 28), ('tephin', 300), ('1cbat', 300)):
+        eng = calibrate(msid, raw)
+        assert isinstance(eng, np.ndarray) and eng.shape == ()
+        assert np.allclose(eng, calibrate(msid, float(raw)))
+
+
+def _copy_tables(tmp_path):
+    """Copy the current version tables to ``tmp_path`` and return the file paths."""
+    for name in tables.keys():
+        np.save(str(tmp_path / (name + '.npy')), tables[name].data)
+    return {name: str(tmp_path / (name + '.npy')) for name in tables.keys()}
+
+
+@pytest.mark.parametrize('raw_dtype, low_raw_count, high_raw_count, raw',
+                         [(np.uint8, 10, 255, [0, 5, 10, 255]),
+                          (np.int8, -128, 127, [-128, 0, 127])])
+def test_calibrate_lut_raw_dtypes(tmp_path, raw_dtype, low_raw_count, high_raw_count, raw):
+    files = _copy_tables(tmp_path)
+    tmsrment = np.load(files['tmsrment'])
+    ok = tmsrment['MSID'] == 'TEPHIN'
+    tmsrment['LOW_RAW_COUNT'][ok] = low_raw_count
+    tmsrment['HIGH_RAW_COUNT'][ok] = high_raw_count
+    np.save(files['tmsrment'], tmsrment)
+
+    tmp_tables = TableDict(str(tmp_path))
+    # Without persisted LUTs none is computed unless asked for
+    assert calib._get_cal_lut(tmp_tables, 'TEPHIN', 'PP', 1) is None
+    assert calib._get_cal_lut(tmp_tables, 'TEPHIN', 'PP', 1, compute=True)[0] == low_raw_count
+
+    calib.write_cal_luts(str(tmp_path))
+    raw = np.array(raw, dtype=raw_dtype)
+    eng_lut = calib._calibrate(tmp_tables, 'TEPHIN', raw, None, True)
+    eng = calib._calibrate(tmp_tables, 'TEPHIN', raw, None, False)
+    assert calib._get_cal_lut(tmp_tables, 'TEPHIN', 'PP', 1)[0] == low_raw_count
+    assert np.allclose(eng_lut, eng)
+
+    # Scalar raw counts, including ones outside the LUT range
+    for raw_val, eng_val in zip(raw, eng):
+        eng_lut = calib._calibrate(tmp_tables, 'TEPHIN', np.asarray(raw_val), None, True)
+        assert eng_lut.shape == ()
+        assert np.allclose(eng_lut, eng_val)
+
+
+def test_decode_states():
+    states = decode_states('aopcadmd', [0, 1, 6])
+    assert states.tolist() == ['STBY', 'NPNT', 'NULL']
+
+
+def test_iter_calibrate():
+    raw = np.arange(256, dtype=np.uint8)
+    chunks = list(iter_calibrate(raw, msid='tephin', chunk_size=100))
+    assert [len(chunk) for chunk in chunks] == [100, 100, 56]
+    assert np.allclose(np.concatenate(chunks), calibrate('tephin', raw))
+
+    raw = np.zeros(10, dtype=[('TEPHIN', np.uint8), ('AOPCADMD', np.uint8)])
+    raw['AOPCADMD'] = 1
+    chunks = list(iter_calibrate(raw, chunk_size=4))
+    assert len(chunks) == 3
+    assert np.allclose(chunks[0]['TEPHIN'], 215.03)
+    assert chunks[2]['AOPCADMD'].tolist() == ['NPNT', 'NPNT']
+
+    chunks = list(iter_calibrate(iter([{'tephin': [0, 255]}, {'aopcadmd': [0]}])))
+    assert np.allclose(chunks[0]['tephin'], [215.03, -103.49045])
+    assert chunks[1]['aopcadmd'].tolist() == ['STBY']
+
+    # Worker processes, including a new MSID after the first chunk
+    chunks = [{'tephin': np.array([0, 255], dtype=np.uint8)},
+              {'tephin': np.array([28], dtype=np.uint8), 'aopcadmd': [6]}]
+    outs = list(iter_calibrate(iter(chunks), processes=2))
+    assert np.allclose(outs[0]['tephin'], [215.03, -103.49045])
+    assert np.allclose(outs[1]['tephin'], [135.846])
+    assert outs[1]['aopcadmd'].tolist() == ['NULL']
+
+    # Calibration set dict keys are case-insensitive like the MSIDs
+    with pytest.raises(ValueError):
+        list(iter_calibrate(iter([{'tephin': [0]}]), cal_set={'TEPHIN': 99}))
+    with pytest.raises(ValueError):
+        list(iter_calibrate(iter([{'TEPHIN': [0]}]), cal_set={'tephin': 99}))
+
+
+def test_iter_calibrate_one_pool(monkeypatch):
+    # A stream of per-MSID chunks uses a single process pool
+    pools = []
+
+    class CountingExecutor(calib.ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            pools.append(self)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(calib, 'ProcessPoolExecutor', CountingExecutor)
+    chunks = [{'tephin': [0]}, {'aopcadmd': [1]}, {'1cbat': [300]}, {'tephin': [255]}]
+    outs = list(iter_calibrate(iter(chunks), processes=2))
+    assert len(pools) == 1
+    assert np.allclose(outs[0]['tephin'], [215.03])
+    assert outs[1]['aopcadmd'].tolist() == ['NPNT']
+    assert np.allclose(outs[2]['1cbat'], calibrate('1cbat', [300]))
+    assert np.allclose(outs[3]['tephin'], [-103.49045])
+
+
+def test_msid_pool():
+    names = ['tephin', 'aopcadmd', '1cbat']
+    raws = [np.arange(256)] * len(names)
+    with MsidPool(processes=2) as pool:
+        engs = pool.map(calibrate, names, raws, chunksize=2)
+        states = pool.map(decode_states, ['aopcadmd'], [[0, 1, 6]])
+    for name, raw, eng in zip(names, raws, engs):
+        assert np.allclose(eng, calibrate(name, raw))
+    assert states[0].tolist() == ['STBY', 'NPNT', 'NULL']
+
+    # Shared table files are removed when an unclosed pool is garbage-collected
+    pool = MsidPool(processes=1)
+    share_dir = pool.share_dir
+    assert os.path.exists(share_dir)
+    del pool
+    gc.collect()
+    assert not os.path.exists(share_dir)
+
+
+def test_complete():
+    tephs = ['TEPHIN', 'TEPHTRP1', 'TEPHTRP2', 'TEPHTRR1', 'TEPHTRR2']
+    assert msids.complete('teph', limit=5) == tephs
+    assert msids.complete('TEPH', limit=2) == tephs[:2]
+    assert msids.complete('tepjin', limit=1, max_dist=1) == ['TEPHIN']
+    assert msids.complete('tepjin', max_dist=0) == []
+
+    assert msids.tephin.msid == 'TEPHIN'
+    assert 'tephin' in dir(msids)
+    assert 'TEPHIN' in msids._ipython_key_completions_()
+
+
+def test_validate(tmp_path):
+    # The regression version must be clean since make_tdb.py rejects any problem by default
+    assert validate_tdb() == []
+
+    # Copy the current version, break some rows and check the problems are found
+    _copy_tables(tmp_path)
+    tmsrment = np.load(str(tmp_path / 'tmsrment.npy'))
+    tmsrment['COUNTER_MSID'][tmsrment['MSID'] == 'TEPHIN'] = 'NOMSID'
+    np.save(str(tmp_path / 'tmsrment.npy'), tmsrment)
+    tpp = np.load(str(tmp_path / 'tpp.npy'))
+    tpp['RAW_COUNT'][tpp['MSID'] == 'TEPHIN'] = 0
+    np.save(str(tmp_path / 'tpp.npy'), tpp)
+    os.remove(str(tmp_path / 'ttdm.npy'))
+
+    problems = set(validate_tdb(str(tmp_path)))
+    assert 'ttdm: table file is missing' in problems
+    assert any(x.startswith('tmsrment: COUNTER_MSID') and 'TEPHIN(NOMSID)' in x
+               for x in problems)
+    assert any(x.startswith('tpp: RAW_COUNT not increasing') and 'TEPHIN(1)' in x
+               for x in problems)
@@ -0,0 +1,246 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""Check the consistency of the tables for a TDB version.
+
+This looks for input problems that would otherwise only show up later as wrong
+values, for instance references to MSIDs that are not in ``tmsrment``, point
+pair calibrations with raw counts that are not increasing, or overlapping state
+code ranges.  All checks are vectorized so a full version takes a few seconds.
+
+From the command line (see ``ska_tdb.validate_cli``)::
+
+  $ python -m ska_tdb.validate_cli 14 15
+  $ python -m ska_tdb.validate_cli data/p016
+"""
+import os
+
+import numpy as np
+
+from . import tdb
+
+__all__ = ['validate_tdb']
+
+TABLE_NAMES = ['tcntr', 'tes', 'tlmt', 'tloc', 'tmsrment', 'towner', 'tpc', 'tpp', 'tsc',
+               'tsmpl', 'tstream', 'ttdm_fmt', 'ttdm']
+
+# Tables with an MSID column that must refer to a tmsrment MSID
+MSID_REF_TABLES = ['tcntr', 'tes', 'tlmt', 'tloc', 'tpc', 'tpp', 'tsc', 'tsmpl']
+
+# tmsrment columns that refer to another MSID, where '0' means no MSID
+TMSRMENT_MSID_COLS = ['COUNTER_MSID', 'RANGE_MSID', 'CALIBRATION_SWITCH_MSID',
+                      'LIMIT_SWITCH_MSID', 'ES_SWITCH_MSID']
+
+# Tables with a STREAM_NUMBER column that must refer to a tstream stream
+STREAM_REF_TABLES = ['tcntr', 'tloc', 'tsmpl']
+
+# Maximum number of bad values listed in each problem message
+MAX_LIST = 10
+
+
+def validate_tdb(data_dir=None):
+    """Check the consistency of the TDB tables in ``data_dir``.
+
+    Examples
+    --------
+
+    >>> from ska_tdb import validate_tdb
+    >>> validate_tdb()
+    []
+
+    Parameters
+    ----------
+    data_dir: str
+        TDB version directory (default is the current TDB version)
+
+    Returns
+    -------
+    list
+        Problems found, each as a string starting with the table name
+    """
+    tables = tdb.TableDict(data_dir)
+    problems = []
+
+    missing = [name for name in TABLE_NAMES
+               if not os.path.exists(os.path.join(tables.data_dir, name + '.npy'))]
+    for name in missing:
+        problems.append('{}: table file is missing'.format(name))
+
+    for check, names in _CHECKS:
+        if not any(name in missing for name in names):
+            problems.extend(check(tables))
+
+    return problems
+
+
+def _check_tmsrment(tables):
+    problems = []
+    tmsrment = tables['tmsrment']
+    msids = tmsrment['MSID']
+
+    vals, counts = np.unique(msids, return_counts=True)
+    if np.any(counts > 1):
+        problems.append('tmsrment: duplicate MSID(s) {}'.format(_fmt_vals(vals[counts > 1])))
+
+    bad = tmsrment['LOW_RAW_COUNT'] > tmsrment['HIGH_RAW_COUNT']
+    if np.any(bad):
+        problems.append('tmsrment: LOW_RAW_COUNT > HIGH_RAW_COUNT for {}'
+                        .format(_fmt_vals(msids[bad])))
+
+    for colname in TMSRMENT_MSID_COLS:
+        refs = tmsrment[colname]
+        bad = ~np.isin(refs, ['0', '']) & ~np.isin(refs, msids)
+        if np.any(bad):
+            problems.append('tmsrment: {} refers to unknown MSID(s) {}'
+                            .format(colname, _fmt_pairs(msids[bad], refs[bad])))
+
+    return problems
+
+
+def _check_owner_refs(tables):
+    tmsrment = tables['tmsrment']
+    bad = ~np.isin(tmsrment['OWNER_ID'], tables['towner']['OWNER_ID'])
+    if np.any(bad):
+        return ['tmsrment: OWNER_ID not in towner for {}'
+                .format(_fmt_pairs(tmsrment['MSID'][bad], tmsrment['OWNER_ID'][bad]))]
+    return []
+
+
+def _check_msid_refs(tables):
+    problems = []
+    msids = tables['tmsrment']['MSID']
+    for name in MSID_REF_TABLES:
+        if not os.path.exists(os.path.join(tables.data_dir, name + '.npy')):
+            continue
+        refs = np.unique(tables[name]['MSID'])
+        bad = ~np.isin(refs, msids)
+        if np.any(bad):
+            problems.append('{}: MSID(s) not in tmsrment {}'.format(name, _fmt_vals(refs[bad])))
+    return problems
+
+
+def _check_stream_refs(tables):
+    problems = []
+    streams = tables['tstream']['STREAM_NUMBER']
+    for name in STREAM_REF_TABLES:
+        if not os.path.exists(os.path.join(tables.data_dir, name + '.npy')):
+            continue
+        refs = np.unique(tables[name]['STREAM_NUMBER'])
+        bad = ~np.isin(refs, streams)
+        if np.any(bad):
+            problems.append('{}: STREAM_NUMBER(s) not in tstream {}'
+                            .format(name, _fmt_vals(refs[bad])))
+    return problems
+
+
+def _check_tdm_refs(tables):
+    refs = np.unique(tables['ttdm_fmt']['TDM_ID'])
+    bad = ~np.isin(refs, tables['ttdm']['TDM_ID'])
+    if np.any(bad):
+        return ['ttdm_fmt: TDM_ID(s) not in ttdm {}'.format(_fmt_vals(refs[bad]))]
+    return []
+
+
+def _check_tpp(tables):
+    problems = []
+    tpp = tables['tpp'].data
+    # Sort by MSID, calibration set and then sequence number
+    tpp = tpp[np.lexsort((tpp['SEQUENCE_NUM'], tpp['CALIBRATION_SET_NUM'], tpp['MSID']))]
+    same = _same_group(tpp, ['MSID', 'CALIBRATION_SET_NUM'])
+    bad = same & (tpp['RAW_COUNT'][1:] <= tpp['RAW_COUNT'][:-1])
+    if np.any(bad):
+        problems.append('tpp: RAW_COUNT not increasing with SEQUENCE_NUM for {}'
+                        .format(_fmt_pairs(tpp['MSID'][1:][bad],
+                                           tpp['CALIBRATION_SET_NUM'][1:][bad])))
+
+    problems.extend(_check_default_cal_sets(tables, 'tpp', 'PP'))
+    return problems
+
+
+def _check_tpc(tables):
+    problems = []
+    tpc = tables['tpc']
+    bad = (tpc['DEG'] < 0) | (tpc['DEG'] > 9)
+    if np.any(bad):
+        problems.append('tpc: DEG not in 0 to 9 for {}'.format(_fmt_vals(tpc['MSID'][bad])))
+
+    problems.extend(_check_default_cal_sets(tables, 'tpc', 'PC'))
+    return problems
+
+
+def _check_tsc(tables):
+    problems = []
+    tsc = tables['tsc'].data
+    bad = tsc['LOW_RAW_COUNT'] > tsc['HIGH_RAW_COUNT']
+    if np.any(bad):
+        problems.append('tsc: LOW_RAW_COUNT > HIGH_RAW_COUNT for {}'
+                        .format(_fmt_pairs(tsc['MSID'][bad], tsc['STATE_CODE'][bad])))
+
+    # Sort by MSID, calibration set and then low raw count
+    tsc = tsc[np.lexsort((tsc['LOW_RAW_COUNT'], tsc['CALIBRATION_SET_NUM'], tsc['MSID']))]
+    same = _same_group(tsc, ['MSID', 'CALIBRATION_SET_NUM'])
+    bad = same & (tsc['LOW_RAW_COUNT'][1:] <= tsc['HIGH_RAW_COUNT'][:-1])
+    if np.any(bad):
+        problems.append('tsc: overlapping raw count ranges for {}'
+                        .format(_fmt_pairs(tsc['MSID'][1:][bad],
+                                           tsc['CALIBRATION_SET_NUM'][1:][bad])))
+    return problems
+
+
+def _check_tlmt(tables):
+    problems = []
+    tlmt = tables['tlmt']
+    for low, high in (('CAUTION_LOW', 'CAUTION_HIGH'), ('WARNING_LOW', 'WARNING_HIGH')):
+        bad = tlmt[low] > tlmt[high]
+        if np.any(bad):
+            problems.append('tlmt: {} > {} for {}'.format(
+                low, high, _fmt_pairs(tlmt['MSID'][bad], tlmt['LIMIT_SET_NUM'][bad])))
+    return problems
+
+
+def _check_default_cal_sets(tables, name, cal_type):
+    """Check MSIDs with ``cal_type`` have their default calibration set in ``name``."""
+    tmsrment = tables['tmsrment'].where(calibration_type=cal_type)
+    cal = tables[name]
+    have = np.char.add(np.char.add(cal['MSID'], ':'),
+                       cal['CALIBRATION_SET_NUM'].astype(str))
+    need = np.char.add(np.char.add(tmsrment['MSID'], ':'),
+                       tmsrment['CALIBRATION_DEFAULT_SET_NUM'].astype(str))
+    bad = ~np.isin(need, have)
+    if np.any(bad):
+        return ['{}: no default calibration set for {} MSID(s) {}'.format(
+            name, cal_type, _fmt_pairs(tmsrment['MSID'][bad],
+                                       tmsrment['CALIBRATION_DEFAULT_SET_NUM'][bad]))]
+    return []
+
+
+def _same_group(dat, colnames):
+    """True where row i + 1 of sorted ``dat`` has the same ``colnames`` values as row i."""
+    same = np.ones(max(len(dat) - 1, 0), dtype=bool)
+    for colname in colnames:
+        same &= dat[colname][1:] == dat[colname][:-1]
+    return same
+
+
+def _fmt_vals(vals):
+    # Unique values in order of first appearance
+    vals = list(dict.fromkeys(str(x) for x in vals))
+    out = ', '.join(vals[:MAX_LIST])
+    if len(vals) > MAX_LIST:
+        out += ' (and {} more)'.format(len(vals) - MAX_LIST)
+    return out
+
+
+def _fmt_pairs(vals1, vals2):
+    return _fmt_vals(['{}({})'.format(x1, x2) for x1, x2 in zip(vals1, vals2)])
+
+
+# Checks and the tables each one requires
+_CHECKS = [(_check_tmsrment, ['tmsrment']),
+           (_check_owner_refs, ['tmsrment', 'towner']),
+           (_check_msid_refs, ['tmsrment']),
+           (_check_stream_refs, ['tstream']),
+           (_check_tdm_refs, ['ttdm', 'ttdm_fmt']),
+           (_check_tpp, ['tmsrment', 'tpp']),
+           (_check_tpc, ['tmsrment', 'tpc']),
+           (_check_tsc, ['tsc']),
+           (_check_tlmt, ['tlmt'])]
+
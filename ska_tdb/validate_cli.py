@@ -0,0 +1,45 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""Command line interface for checking the consistency of TDB versions.
+
+This is kept out of ``ska_tdb.validate`` (which the package imports) so that
+running it with ``python -m`` does not import the module twice::
+
+  $ python -m ska_tdb.validate_cli 14 15
+  $ python -m ska_tdb.validate_cli data/p016
+"""
+import os
+import sys
+import argparse
+
+from . import tdb
+from .validate import validate_tdb
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Check the consistency of TDB versions')
+    parser.add_argument('versions', nargs='*',
+                        help='TDB version numbers or version directories (default=current)')
+    return parser
+
+
+def main(args=None):
+    opt = get_parser().parse_args(args)
+    data_dirs = []
+    for version in opt.versions or [tdb.get_tdb_version()]:
+        if str(version).isdigit():
+            version = os.path.join(tdb.SKA, 'data', 'Ska.tdb', 'p{:03d}'.format(int(version)))
+        data_dirs.append(version)
+
+    n_problems = 0
+    for data_dir in data_dirs:
+        problems = validate_tdb(data_dir)
+        print('{}: {} problem(s)'.format(data_dir, len(problems)))
+        for problem in problems:
+            print('  ' + problem)
+        n_problems += len(problems)
+
+    return 1 if n_problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())